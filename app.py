@@ -1,11 +1,22 @@
 import os
-import json
+import gzip
 import hashlib
 import re
 import ipaddress
+import string
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, render_template_string, redirect, url_for, send_from_directory, abort, request
+from functools import lru_cache
+from cachetools import TTLCache
+import brotli
+import orjson
+from flask import Flask, Response, redirect, url_for, send_from_directory, abort, request
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 app = Flask(__name__)
 
@@ -17,6 +28,9 @@ BLOCKED_USER_AGENTS = [
     'Slurp', 'DuckDuckBot', 'Baiduspider', 'YandexBot', 'Sogou'
 ]
 
+# Single alternation over all bot tokens, so a User-Agent is scanned once rather than once per token
+BLOCKED_USER_AGENTS_RE = re.compile('|'.join(re.escape(bot.lower()) for bot in BLOCKED_USER_AGENTS))
+
 # Meta IP ranges (example ranges - you should regularly update these)
 META_IP_RANGES = [
     '157.240.0.0/16',
@@ -28,24 +42,31 @@ META_IP_RANGES = [
     '74.119.76.0/22',
 ]
 
+# Parsed once at import rather than on every request
+META_NETWORKS = tuple(ipaddress.ip_network(range) for range in META_IP_RANGES)
+
 def is_meta_ip(ip):
     """Check if an IP is in Meta's ranges"""
     try:
         ip_addr = ipaddress.ip_address(ip)
-        return any(ip_addr in ipaddress.ip_network(range) for range in META_IP_RANGES)
+        return any(ip_addr in network for network in META_NETWORKS)
     except ValueError:
         return False
 
-@app.before_request
-def log_and_block():
-    """Log request and block unwanted visitors"""
-    # Get request details
+# Security headers, sent on every response including those rejected by the middleware
+SECURITY_HEADERS = {
+    'X-Content-Type-Options': 'nosniff',
+    'X-Frame-Options': 'DENY',
+    'X-XSS-Protection': '1; mode=block',
+    'Content-Security-Policy': "default-src 'self'; style-src 'unsafe-inline' https://fonts.googleapis.com; font-src https://fonts.gstatic.com; script-src 'unsafe-inline'",
+    'X-Robots-Tag': 'noindex, nofollow, noarchive',
+    'X-Crawler': 'no-crawl',
+    'CommonCrawl': 'no-crawl',
+}
+
+def log_request(ip, path, user_agent):
+    """Append a request to the request log"""
     timestamp = datetime.now().isoformat()
-    ip = request.remote_addr
-    path = request.path
-    user_agent = request.headers.get('User-Agent', '')
-    
-    # Log to file
     log_file = os.path.join(CACHE_DIR, 'requests')
     try:
         with open(log_file, 'a') as f:
@@ -53,74 +74,160 @@ def log_and_block():
     except IOError as e:
         app.logger.error(f"Failed to write to request log: {str(e)}")
 
+def get_block_reason(ip, user_agent):
+    """Return why a visitor should be blocked, or None if they are allowed"""
     # Block crawlers
-    if any(bot.lower() in user_agent.lower() for bot in BLOCKED_USER_AGENTS):
-        abort(403, "Crawlers not allowed")
+    if BLOCKED_USER_AGENTS_RE.search(user_agent.lower()):
+        return "Crawlers not allowed"
     
     # Block Meta IPs
     if is_meta_ip(ip):
-        abort(403, "Access denied")
+        return "Access denied"
+    return None
+
+def block_unwanted_visitors(wsgi_app):
+    """WSGI middleware that logs requests and rejects unwanted visitors before Flask sees them"""
+    def middleware(environ, start_response):
+        ip = environ.get('REMOTE_ADDR')
+        user_agent = environ.get('HTTP_USER_AGENT', '')
+        # WSGI hands PATH_INFO over as latin-1; re-decode it as UTF-8 the way Werkzeug does
+        path = environ.get('PATH_INFO', '').encode('latin-1').decode('utf-8', 'replace')
+        log_request(ip, path, user_agent)
+        reason = get_block_reason(ip, user_agent)
+        if reason:
+            body = reason.encode('utf-8')
+            start_response('403 Forbidden', [
+                ('Content-Type', 'text/plain; charset=utf-8'),
+                ('Content-Length', str(len(body))),
+                *SECURITY_HEADERS.items(),
+            ])
+            return [body]
+        environ['anysite.screened'] = True
+        return wsgi_app(environ, start_response)
+    return middleware
+
+app.wsgi_app = block_unwanted_visitors(app.wsgi_app)
+
+@app.before_request
+def log_and_block():
+    """Log request and block unwanted visitors, unless the WSGI middleware already has"""
+    if request.environ.get('anysite.screened'):
+        return
+    ip = request.remote_addr
+    user_agent = request.headers.get('User-Agent', '')
+    log_request(ip, request.path, user_agent)
+    reason = get_block_reason(ip, user_agent)
+    if reason:
+        abort(403, reason)
 
 # Security headers
 @app.after_request
 def add_security_headers(response):
-    response.headers['X-Content-Type-Options'] = 'nosniff'
-    response.headers['X-Frame-Options'] = 'DENY'
-    response.headers['X-XSS-Protection'] = '1; mode=block'
-    response.headers['Content-Security-Policy'] = "default-src 'self'; style-src 'unsafe-inline' https://fonts.googleapis.com; font-src https://fonts.gstatic.com; script-src 'unsafe-inline'"
-    response.headers['X-Robots-Tag'] = 'noindex, nofollow, noarchive'
-    response.headers['X-Crawler'] = 'no-crawl'
-    response.headers['CommonCrawl'] = 'no-crawl'
+    response.headers.update(SECURITY_HEADERS)
     return response
 
 # Ensure cache directory exists
 CACHE_DIR = '/cache'
 os.makedirs(CACHE_DIR, exist_ok=True)
 
+# In-process cache of rendered pages in front of the cache files, so repeat hits skip disk entirely
+CACHE_TTL = 86400
+_memory_cache = TTLCache(maxsize=4096, ttl=CACHE_TTL)
+_memory_cache_lock = threading.Lock()
+
+# Pages are compressed once when cached and served precompressed: encoding -> (file suffix, compressor)
+PRECOMPRESSORS = {
+    'br': ('.br', lambda page: brotli.compress(page, quality=5)),
+    'gzip': ('.gz', lambda page: gzip.compress(page, compresslevel=6, mtime=0)),
+}
+
+# Characters stripped from paths before hashing, to prevent directory traversal
+UNSAFE_PATH_CHARS_RE = re.compile(r'[^a-zA-Z0-9\-_.]')
+
+@lru_cache(maxsize=4096)
+def get_cache_key(path):
+    """Hash the URL path into a cache key (memoized, as each request looks it up more than once)"""
+    # Sanitize path to prevent directory traversal
+    safe_path = UNSAFE_PATH_CHARS_RE.sub('', path)
+    return hashlib.sha256(safe_path.encode(), usedforsecurity=False).hexdigest()[:32]
+
 def get_cache_path(path):
     """Generate a unique cache file path for the given URL path"""
-    # Sanitize path to prevent directory traversal
-    safe_path = re.sub(r'[^a-zA-Z0-9-_.]', '', path)
-    hash_object = hashlib.md5(safe_path.encode())
-    cache_path = os.path.join(CACHE_DIR, f"{hash_object.hexdigest()}.json")
+    cache_path = os.path.join(CACHE_DIR, f"{get_cache_key(path)}.html")
     app.logger.info(f"Cache path for {path}: {cache_path}")
     return cache_path
 
-def get_cached_content(path):
-    """Retrieve cached content if it exists"""
+def get_page_etag(page):
+    """Derive an ETag from the rendered page bytes, so it changes whenever the page is regenerated"""
+    return hashlib.sha256(page, usedforsecurity=False).hexdigest()[:32]
+
+def get_cached_content(path, encoding=None):
+    """Retrieve the cached rendered page (as bytes, optionally precompressed), its ETag and expiry time if it exists and is still fresh"""
     cache_path = get_cache_path(path)
-    if os.path.exists(cache_path):
-        try:
+    if encoding:
+        cache_path += PRECOMPRESSORS[encoding][0]
+    with _memory_cache_lock:
+        cached = _memory_cache.get(cache_path)
+    # Memory entries carry the file's own expiry, not a fresh CACHE_TTL from when they were loaded
+    if cached is not None and cached[2] > time.time():
+        return cached
+    try:
+        with open(cache_path, 'rb') as f:
+            # The file's mtime doubles as the cache timestamp
+            expires_at = os.fstat(f.fileno()).st_mtime + CACHE_TTL
+            if expires_at <= time.time():
+                app.logger.info(f"Cache file expired: {cache_path}")
+                return None
             app.logger.info(f"Found cache file: {cache_path}")
-            with open(cache_path, 'r') as f:
-                cached_data = json.load(f)
-                return cached_data['content']
-        except (json.JSONDecodeError, KeyError, ValueError, IOError) as e:
-            app.logger.error(f"Error reading cache file {cache_path}: {str(e)}")
-            if os.access(cache_path, os.W_OK):
-                app.logger.info(f"Cache file is writable")
-            else:
-                app.logger.error(f"Cache file is not writable")
-    else:
+            page = f.read()
+    except FileNotFoundError:
         app.logger.info(f"No cache file found at: {cache_path}")
         if os.access(CACHE_DIR, os.W_OK):
             app.logger.info(f"Cache directory is writable")
         else:
             app.logger.error(f"Cache directory is not writable")
-    return None
+        return None
+    except IOError as e:
+        app.logger.error(f"Error reading cache file {cache_path}: {str(e)}")
+        if os.access(cache_path, os.W_OK):
+            app.logger.info(f"Cache file is writable")
+        else:
+            app.logger.error(f"Cache file is not writable")
+        return None
+    cached = (page, get_page_etag(page), expires_at)
+    with _memory_cache_lock:
+        _memory_cache[cache_path] = cached
+    return cached
 
-def cache_content(path, content):
-    """Save content to cache"""
+def write_cache_file(cache_path, body):
+    """Write a cache file atomically, so readers never see a partially written page"""
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    try:
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb', buffering=1 << 16) as f:
+            f.write(body)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def cache_content(path, page, etag, expires_at):
+    """Save a rendered page (as bytes), its ETag and expiry time to cache, along with its precompressed variants"""
     try:
         cache_path = get_cache_path(path)
-        cache_data = {
-            'content': content,
-            'timestamp': datetime.now().isoformat()
-        }
-        app.logger.info(f"Attempting to write cache file: {cache_path}")
-        with open(cache_path, 'w') as f:
-            json.dump(cache_data, f)
-        app.logger.info(f"Successfully wrote cache file: {cache_path}")
+        entries = [(cache_path, page, etag)]
+        for suffix, compress in PRECOMPRESSORS.values():
+            compressed = compress(page)
+            entries.append((cache_path + suffix, compressed, get_page_etag(compressed)))
+        for entry_path, body, body_etag in entries:
+            app.logger.info(f"Attempting to write cache file: {entry_path}")
+            with _memory_cache_lock:
+                _memory_cache[entry_path] = (body, body_etag, expires_at)
+            write_cache_file(entry_path, body)
+            app.logger.info(f"Successfully wrote cache file: {entry_path}")
     except IOError as e:
         app.logger.error(f"Failed to write to cache file {cache_path}: {str(e)}")
         # Check permissions
@@ -132,25 +239,61 @@ PROMPT_FILE = os.path.join(os.path.dirname(__file__), 'prompt.txt')
 with open(PROMPT_FILE, 'r') as f:
     DEFAULT_PROMPT = f.read().strip()
 
+def split_prompt(template):
+    """Split a prompt template into the literal text around its {path} fields"""
+    parts = ['']
+    for literal, field, _, _ in string.Formatter().parse(template):
+        parts[-1] += literal
+        if field is not None:
+            parts.append('')
+    return parts
+
+# Pre-split so filling in the prompt is a single join instead of a str.format parse
+PROMPT_PARTS = split_prompt(DEFAULT_PROMPT)
+
 # Environment variables with defaults
 OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY', 'none')
 OPENROUTER_MODEL = os.getenv('OPENROUTER_MODEL', 'google/gemini-2.0-flash-001')
 
+# Behind a server that honours X-Sendfile, let it stream static files instead of Python
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '0') == '1'
+
+# How long browsers may reuse the static files before revalidating
+STATIC_MAX_AGE = 3600
+
 # Base HTML template
 BASE_TEMPLATE = """
 <!DOCTYPE html>
     {{ content | safe }}
 """
 
+# Matches a whole line containing a backtick, plus its newline
+BACKTICK_LINE_RE = re.compile(r'^[^`\n]*`.*\n?', re.M)
+
+# Compile the page template once instead of on every render
+PAGE_TEMPLATE = app.jinja_env.from_string(BASE_TEMPLATE)
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+# Static request headers, built once rather than per call
+OPENROUTER_HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "HTTP-Referer": "http://localhost:9999",  # Required for OpenRouter API
+    "Content-Type": "application/json"
+}
+
+# Shared session so consecutive cache misses reuse pooled keep-alive connections
+# instead of paying a fresh TCP+TLS handshake to OpenRouter every time
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
+
 def generate_content(path):
     """Generate content for the requested path using OpenRouter API"""
-    prompt = DEFAULT_PROMPT.format(path=path)
-
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "HTTP-Referer": "http://localhost:9999",  # Required for OpenRouter API
-        "Content-Type": "application/json"
-    }
+    prompt = path.join(PROMPT_PARTS)
 
     data = {
         "model": OPENROUTER_MODEL,
@@ -158,10 +301,11 @@ def generate_content(path):
     }
 
     try:
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers=headers,
-            json=data
+        response = _session.post(
+            OPENROUTER_URL,
+            headers=OPENROUTER_HEADERS,
+            data=orjson.dumps(data),
+            timeout=(3.05, 60)
         )
         
         # Check for rate limiting
@@ -170,7 +314,7 @@ def generate_content(path):
             return prompt, error_msg
             
         response.raise_for_status()
-        response_json = response.json()
+        response_json = orjson.loads(response.content)
         
         # Debug logging
         print("API Response:", response_json)
@@ -185,11 +329,7 @@ def generate_content(path):
         content = content.replace('```html', '').replace('```', '')
         
         # Remove any lines containing backtick patterns
-        cleaned_lines = []
-        for line in content.split('\n'):
-            if '`);' not in line and '`' not in line:
-                cleaned_lines.append(line)
-        content = '\n'.join(cleaned_lines).strip()
+        content = BACKTICK_LINE_RE.sub('', content).strip()
         
         return prompt, content
     except requests.exceptions.RequestException as e:
@@ -202,12 +342,101 @@ def generate_content(path):
 @app.route('/robots.txt')
 def robots():
     """Serve robots.txt file"""
-    return send_from_directory('.', 'robots.txt')
+    return send_from_directory('.', 'robots.txt', conditional=True, etag=True, max_age=STATIC_MAX_AGE)
 
 @app.route('/')
 def index():
     """Serve the index.html file"""
-    return send_from_directory('.', 'index.html')
+    return send_from_directory('.', 'index.html', conditional=True, etag=True, max_age=STATIC_MAX_AGE)
+
+# Allowed page paths; \Z (unlike $) also rejects a trailing newline
+VALID_PATH_RE = re.compile(r'^[a-zA-Z0-9_\-/]+\Z')
+
+@lru_cache(maxsize=4096)
+def make_title(path):
+    """Turn a URL path into a page title"""
+    return path.replace('-', ' ').replace('/', ' - ').title()
+
+def page_response(page, etag, expires_at, encoding=None):
+    """Build the response for a rendered page, answering 304 if the client already has it"""
+    # Bytes are sent as-is (possibly precompressed), so Werkzeug needn't touch them
+    response = Response(page, mimetype='text/html', direct_passthrough=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    # Let browsers/CDNs reuse the page only for as long as it stays cached here; set before
+    # make_conditional so a 304 repeats it too
+    max_age = max(0, int(expires_at - time.time()))
+    response.headers['Cache-Control'] = f'public, max-age={max_age}'
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+def render_page(path, base_path):
+    """Generate and render the page for a path, returning its bytes, ETag and expiry time"""
+    # Clean up path for title
+    title = make_title(base_path)
+    
+    # Generate new content
+    prompt, content = generate_content(path)
+    
+    # Escape backticks and backslashes for JavaScript template literal
+    safe_prompt = prompt.replace('\\', '\\\\').replace('`', '\\`')
+    safe_content = content.replace('\\', '\\\\').replace('`', '\\`')
+    
+    # Render with base template and debug info
+    page = PAGE_TEMPLATE.render(
+        title=title,
+        content=content,
+        debug_prompt=safe_prompt,
+        debug_response=safe_content
+    ).encode('utf-8')
+    return page, get_page_etag(page), time.time() + CACHE_TTL
+
+# Pages currently being rendered, so concurrent misses for a path share one OpenRouter call
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Compressing and writing new pages happens here, off the request thread
+_cache_writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cachewrite')
+
+def store_page(path, page, etag, expires_at):
+    """Cache a freshly rendered page, then release its in-flight entry"""
+    try:
+        cache_content(path, page, etag, expires_at)
+    except Exception as e:
+        app.logger.error(f"Failed to cache page for {path}: {str(e)}")
+    finally:
+        with _inflight_lock:
+            _inflight.pop(path, None)
+
+def render_page_once(path, base_path):
+    """Render and cache a page, coalescing concurrent requests for the same path into one render"""
+    with _inflight_lock:
+        future = _inflight.get(path)
+        is_leader = future is None
+        if is_leader:
+            future = _inflight[path] = Future()
+    if not is_leader:
+        return future.result()
+
+    try:
+        # A previous leader may have cached the page between our miss and taking the lock
+        cached = get_cached_content(path)
+        result = cached or render_page(path, base_path)
+    except BaseException as e:
+        with _inflight_lock:
+            _inflight.pop(path, None)
+        future.set_exception(e)
+        raise
+    future.set_result(result)
+    if cached:
+        with _inflight_lock:
+            _inflight.pop(path, None)
+        return result
+
+    # The entry is kept until the page is cached, so late arrivals reuse the result instead of re-rendering
+    _cache_writer.submit(store_page, path, *result)
+    return result
 
 @app.route('/<path:path>')
 def dynamic_page(path):
@@ -220,41 +449,19 @@ def dynamic_page(path):
     base_path = path[:-5] if path.endswith('.html') else path
     
     # Validate path
-    if not re.match(r'^[a-zA-Z0-9-_/]+$', base_path):
+    if not VALID_PATH_RE.match(base_path):
         abort(400, description="Invalid path")
     
-    # Clean up path for title
-    title = base_path.replace('-', ' ').replace('/', ' - ').title()
-    
-    # Check cache first
-    cached_content = get_cached_content(path)
-    if cached_content:
-        return render_template_string(
-            BASE_TEMPLATE,
-            title=title,
-            content=cached_content,
-            debug_prompt="(Cached) Original prompt not available",
-            debug_response="(Cached) Original response not available"
-        )
-    
-    # Generate new content if not cached
-    prompt, content = generate_content(path)
-    
-    # Cache the new content
-    cache_content(path, content)
-    
-    # Escape backticks and backslashes for JavaScript template literal
-    safe_prompt = prompt.replace('\\', '\\\\').replace('`', '\\`')
-    safe_content = content.replace('\\', '\\\\').replace('`', '\\`')
+    # Cache hits are served as the already rendered page, precompressed if the client accepts it
+    encoding = request.accept_encodings.best_match(tuple(PRECOMPRESSORS))
+    cached = encoding and get_cached_content(path, encoding)
+    if cached:
+        return page_response(*cached, encoding=encoding)
+    cached = get_cached_content(path)
+    if cached:
+        return page_response(*cached)
     
-    # Render with base template and debug info
-    return render_template_string(
-        BASE_TEMPLATE,
-        title=title,
-        content=content,
-        debug_prompt=safe_prompt,
-        debug_response=safe_content
-    )
+    return page_response(*render_page_once(path, base_path))
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)